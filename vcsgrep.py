@@ -11,10 +11,13 @@ Install by symlinking vcsgrep.py as "hgg" and/or "ggit" in your ~/bin
 or similar, then run "hgg --help" / "ggit --help".
 """
 
-import fcntl
+import concurrent.futures
+import functools
 import os
 import re
 import shlex
+import signal
+import string
 import subprocess
 import sys
 
@@ -22,17 +25,37 @@ import sys
 version = '0.9'
 editor_flags = ['--vim', '--gvim']
 editors_that_need_stdin = ['vim']
+# --OPTION switches handled by vcsgrep itself (stored as ArgParser attributes)
+vcsgrep_switch_options = frozenset({'explain', 'help', 'show', 'version'})
 
 # default to exended regex matching instead of basic (-G).
 grep_default_matcher = '-E'
 # these matcher selection flags override the default
-grep_flags_matcher_select = 'EFGP'
+grep_flags_matcher_select = frozenset('EFGP')
 # if -e or -f is used, there's no implicit ("unflagged") pattern argument
-grep_flags_suppress_implicit_pattern_arg = 'ef'
+grep_flags_suppress_implicit_pattern_arg = frozenset('ef')
 # these grep flags are followed by an argument
-grep_flags_with_argument = 'efmABCdD'
-
-
+grep_flags_with_argument = frozenset('efmABCdD')
+# short flags that affect argument parsing; other flags are just passed on
+grep_flags_of_interest = (
+    grep_flags_matcher_select
+    | grep_flags_suppress_implicit_pattern_arg
+    | grep_flags_with_argument
+    | {'V'}
+)
+
+# characters that never need quoting in a shell word (ASCII subset of shlex's)
+shell_safe_chars = frozenset(string.ascii_letters + string.digits + '@%+=:,./-_')
+
+# '.' path segments, which are dropped from globs
+glob_dot_segment_re = re.compile(r'(^|(?<=/))\.(/|$)')
+# glob special tokens; literal text is found between these
+glob_token_re = re.compile(r'(\*\*/?|[*?,{}]|\[[^]]+\])')
+# escapes the characters that are special in a grep -E regex
+grep_escape_table = str.maketrans({c: '\\' + c for c in r'\^$.|?*+()[]{}'})
+
+
+@functools.lru_cache(maxsize=1024)
 def glob_to_grep_pattern(glob):
     r""" Performs an approximate translation from a (Mercurial-like)
         extended glob pattern into a regex suitable for grepping paths.
@@ -53,9 +76,11 @@ def glob_to_grep_pattern(glob):
         >>> glob_to_grep_pattern('.')
         ''
         >>> glob_to_grep_pattern('./foo/./bar')
-        '^foo\\/bar(/|$)'
+        '^foo/bar(/|$)'
         >>> glob_to_grep_pattern('../foo/bar**')
-        '^\\.\\.\\/foo\\/bar.*(/|$)'
+        '^\\.\\./foo/bar.*(/|$)'
+        >>> glob_to_grep_pattern('my-file (1)+.c')
+        '^my-file \\(1\\)\\+\\.c(/|$)'
 
         Mercurial supports nested globbing inside braces, too:
         >>> glob_to_grep_pattern('main.{[ch],[ch]pp,*zzz}')
@@ -75,37 +100,38 @@ def glob_to_grep_pattern(glob):
         ...
         ValueError: invalid glob pattern (unexpected "}"): foo{bar}}
     """
-    glob2 = re.sub(r'(^|(?<=/))\.(/|$)', '', glob)
+    glob2 = glob_dot_segment_re.sub('', glob)
     if not glob2:
         return ''
 
     brace_depth = 0
     result = ['^']
-    for i, piece in enumerate(re.split(r'(\*\*/?|[*?,{}]|\[[^]]+\])', glob2)):
+    append = result.append
+    for i, piece in enumerate(glob_token_re.split(glob2)):
         if not piece:
             continue
         if i % 2 == 0:
-            result.append(re.escape(piece))
+            append(piece.translate(grep_escape_table))
         elif piece == '?':
-            result.append('.')
+            append('.')
         elif piece == '*':
-            result.append('[^/]*')
+            append('[^/]*')
         elif piece[0] == '*': # '**' or '**/'
-            result.append('.*')
+            append('.*')
         elif piece[0] == '[':
-            result.append(piece)
+            append(piece)
         elif piece == '{':
-            result.append('(')
+            append('(')
             brace_depth += 1
         elif piece == ',':
             if brace_depth == 0:
-                result.append(',')
+                append(',')
             else:
-                result.append('|')
+                append('|')
         elif piece == '}':
             if brace_depth == 0:
                 raise ValueError('invalid glob pattern (unexpected "}"): %s' % glob)
-            result.append(')')
+            append(')')
             brace_depth -= 1
         else:
             assert False, piece
@@ -153,6 +179,11 @@ class ArgParser:
         grep_color_arg: '--color'
         include_globs: ['src/**{.cpp}', 'docs/**{.cpp}']
 
+        >>> ArgParser('pat', '.cpp', 'src//')
+        grep_args: ['-E', 'pat']
+        grep_color_arg: '--color'
+        include_globs: ['src/**{.cpp}']
+
         >>> ArgParser('.pattern', 'glob1', '.extglob', '*.glob2', '*/glob3')
         grep_args: ['-E', '.pattern']
         grep_color_arg: '--color'
@@ -166,6 +197,21 @@ class ArgParser:
         grep_args: ['-Ff', 'pattern-file']
         grep_color_arg: '--color'
 
+        Flag arguments are never mistaken for flags, so these keep -E:
+        >>> ArgParser('-fEfile')
+        grep_args: ['-E', '-fEfile']
+        grep_color_arg: '--color'
+
+        >>> ArgParser('-e', '-F', 'path')
+        grep_args: ['-E', '-e', '-F']
+        grep_color_arg: '--color'
+        include_globs: ['path']
+
+        >>> ArgParser('-in', 'hello', '-C', '3', 'path')
+        grep_args: ['-E', '-in', 'hello', '-C', '3']
+        grep_color_arg: '--color'
+        include_globs: ['path']
+
         >>> ArgParser('-e', 'pat1', '-e', 'pat2', 'path')
         grep_args: ['-E', '-e', 'pat1', '-e', 'pat2']
         grep_color_arg: '--color'
@@ -192,6 +238,10 @@ class ArgParser:
         grep_args: ['hello', '-GV']
         grep_color_arg: '--color'
         version: True
+
+        Every attribute must be listed in _repr_keys to show up in --explain:
+        >>> set(ArgParser._repr_keys) == set(vars(ArgParser()))
+        True
     """
 
     def __init__(self, *args):
@@ -212,51 +262,65 @@ class ArgParser:
         next_arg_processor = None
         awaiting_implicit_pattern_arg = True
 
+        # bind the list appends to locals for the loop below
+        grep_args_append = self.grep_args.append
+        include_globs_append = self.include_globs.append
+        exclude_globs_append = self.exclude_globs.append
+        revisions_append = self.revisions.append
+        extension_globs_append = extension_globs.append
+
         for arg in args:
             if next_arg_processor is not None:
                 next_arg_processor(arg)
                 next_arg_processor = None
-            elif arg in editor_flags:
-                self.editor = arg.lstrip('-')
-            elif arg in ('--explain', '--help', '--show', '--version'):
-                setattr(self, arg[2:], True)
-            elif arg == '-X':
-                next_arg_processor = self.exclude_globs.append
-            elif arg == '--color' or arg.startswith('--color='):
-                self.grep_color_arg = arg
-            elif arg == '--rev' or arg.startswith('-r'):
-                if arg in ('--rev', '-r'):
-                    next_arg_processor = self.revisions.append
+            elif arg[:2] == '--':
+                # long options
+                if arg in editor_flags:
+                    self.editor = arg[2:]
+                elif arg[2:] in vcsgrep_switch_options:
+                    setattr(self, arg[2:], True)
+                elif arg == '--color' or arg.startswith('--color='):
+                    self.grep_color_arg = arg
+                elif arg == '--rev':
+                    next_arg_processor = revisions_append
+                else:
+                    grep_args_append(arg)
+            elif arg[:2] == '-r':
+                if arg == '-r':
+                    next_arg_processor = revisions_append
                 else:
-                    self.revisions.append(arg[2:])
+                    revisions_append(arg[2:])
+            elif arg == '-X':
+                next_arg_processor = exclude_globs_append
             elif len(arg) >= 2 and arg[0] == '-':
-                self.grep_args.append(arg)
+                # short options
+                grep_args_append(arg)
 
                 # determine if there's a follow-up argument
-                if arg[1] != '-':
-                    for i in range(1, len(arg)):
-                        if arg[i] == 'V':
+                if not grep_flags_of_interest.isdisjoint(arg[1:]):
+                    for i, c in enumerate(arg[1:], 1):
+                        if c == 'V':
                             self.version = True
                             continue
-                        if arg[i] in grep_flags_suppress_implicit_pattern_arg:
+                        if c in grep_flags_suppress_implicit_pattern_arg:
                             awaiting_implicit_pattern_arg = False
-                        elif arg[i] in grep_flags_matcher_select:
+                        elif c in grep_flags_matcher_select:
                             use_default_matcher = False
 
-                        if arg[i] in grep_flags_with_argument:
+                        if c in grep_flags_with_argument:
                             # see if flag argument is separate (-C 3) or "embedded" (-C3)
                             if i == len(arg) - 1:
                                 # next arg is for grep
-                                next_arg_processor = self.grep_args.append
+                                next_arg_processor = grep_args_append
                             break
 
             elif awaiting_implicit_pattern_arg:
                 awaiting_implicit_pattern_arg = False
-                self.grep_args.append(arg)
+                grep_args_append(arg)
             elif arg.startswith('.') and '/' not in arg:
-                extension_globs.append(arg)
+                extension_globs_append(arg)
             else:
-                self.include_globs.append(arg)
+                include_globs_append(arg)
 
         if extension_globs:
             ext = '**{%s}' % ','.join(extension_globs)
@@ -268,20 +332,43 @@ class ArgParser:
         if use_default_matcher:
             self.grep_args.insert(0, grep_default_matcher)
 
+    # attributes shown by repr() (and hence --explain), in display order
+    _repr_keys = (
+        'editor', 'exclude_globs', 'explain', 'grep_args', 'grep_color_arg',
+        'help', 'include_globs', 'revisions', 'show', 'version',
+    )
+
     def __repr__(self):
         return '\n'.join(
-            '%s: %r' % (k, v)
-            for k, v in sorted(self.__dict__.items())
-            if k[0] != '_' and v
+            '%s: %r' % (k, getattr(self, k))
+            for k in self._repr_keys
+            if getattr(self, k)
         )
 
 
-def globs_to_grep_pipe(prog, patterns):
+def util_version(util):
+    """ Returns the first line of "UTIL --version", or None if the utility
+        is missing or fails.
+    """
+    try:
+        p = subprocess.run([util, '--version'], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    except OSError:
+        return None
+    lines = p.stdout.decode('utf-8', 'replace').splitlines()
+    if p.returncode != 0 or not lines:
+        return None
+    return lines[0]
+
+
+def globs_to_grep_args(prog, patterns):
     try:
-        # (TODO: grep -z -Z is not available on OS X)
-        return '| grep -EzZ %s' % quote(map(glob_to_grep_pattern, patterns), pattern='-e %s')
+        # (globs can translate to the same regex, e.g. 'src' and './src', so
+        # pass each regex to grep only once, keeping the original order)
+        regexes = dict.fromkeys(map(glob_to_grep_pattern, patterns))
     except ValueError as e:
         raise SystemExit('%s: %s' % (prog, e))
+    # (TODO: grep -z -Z is not available on OS X)
+    return ['grep', '-EzZ'] + [a for regex in regexes for a in ('-e', regex)]
 
 
 if __name__ == '__main__':
@@ -292,23 +379,15 @@ if __name__ == '__main__':
     else:
         raise SystemExit('%s: must be invoked as "hgg" or "gitg"' % sys.argv[0])
 
-    args = ArgParser(*sys.argv[1:])
-
-    if args.explain:
-        print(args)
-        sys.exit(0)
-
-    if args.version:
+    def show_version_and_exit():
         print('vcsgrep %s' % version)
-        for util in 'grep', 'sed', 'xargs', 'hg', 'git':
-            try:
-                output = subprocess.check_output(util + ' --version', shell=True, stderr=subprocess.STDOUT)
-                print(output.decode('utf-8', 'replace').splitlines()[0])
-            except subprocess.CalledProcessError:
-                print('%s: not found or broken (or BSD/macOS version?)' % util)
+        utils = ('grep', 'sed', 'xargs', 'hg', 'git')
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(utils)) as executor:
+            for util, line in zip(utils, executor.map(util_version, utils)):
+                print(line or '%s: not found or broken (or BSD/macOS version?)' % util)
         sys.exit(0)
 
-    if args.help or len(sys.argv) < 2 or sys.argv[1:] == ['-h']:
+    def show_help_and_exit():
         sys.stderr.write('''\
 usage: {prog} [--show] [{editor_flags_pipe}] [GREP-OPTIONS] GREP-PATTERN... [FILE-PATTERN]...
 Searches for GREP-PATTERN across tracked files (filtered by FILE-PATTERNs,
@@ -326,6 +405,9 @@ adds e.g. '/**.py').
 Use --show to see the grep command instead of executing it. Use one of
 {editor_flags_comma} to open matching files in editor. Use --explain
 to explain how exactly the {prog} arguments were parsed.
+
+Set VCSGREP_JOBS=N to run N greps in parallel. Output order then varies,
+and the exit status is 123 unless every batch of files has a match.
 '''.format(
             prog=prog,
             editor_flags_pipe='|'.join(editor_flags),
@@ -339,42 +421,128 @@ only files changed between revisions R1 and R2.
 ''')
         sys.exit(1)
 
-    grep = 'grep --binary-files=without-match -H'
+    # settle the common no-op invocations without parsing the arguments
+    argv = sys.argv[1:]
+    if not argv or argv in (['-h'], ['--help']):
+        show_help_and_exit()
+    if argv == ['--version']:
+        show_version_and_exit()
+
+    args = ArgParser(*argv)
+
+    if args.explain:
+        print(args)
+        sys.exit(0)
+
+    if args.version:
+        show_version_and_exit()
+
+    if args.help:
+        show_help_and_exit()
 
-    def quote(args, pattern='%s'):
-        return ' '.join(pattern % shlex.quote(a) for a in args)
+    # (ripgrep would be faster, but isn't a drop-in replacement: it reports
+    # "binary file matches" for files named on its command line, where we rely
+    # on --binary-files=without-match, and GREP-OPTIONS are passed through
+    # as-is, e.g. -G and -s mean something else to rg.)
+    grep = ['grep', '--binary-files=without-match', '-H']
+
+    try:
+        jobs = int(os.environ.get('VCSGREP_JOBS') or 1)
+    except ValueError:
+        raise SystemExit('%s: VCSGREP_JOBS must be a number' % prog)
+    if jobs > 1:
+        # run several greps in parallel (opt-in, as xargs then exits with 123
+        # unless every batch has a match); line buffering makes every output
+        # line a single write, so lines from different greps don't interleave
+        xargs = ['xargs', '-0', '-P', str(jobs), '-n', '256']
+        grep.append('--line-buffered')
+    else:
+        xargs = ['xargs', '-0']
+
+    def shell_quote(s):
+        # shlex.quote, minus its regex search for the common all-safe case
+        if s and shell_safe_chars.issuperset(s):
+            return s
+        return shlex.quote(s)
+
+    def quote(args):
+        return ' '.join(map(shell_quote, args))
+
+    def each(flag, values):
+        return [a for value in values for a in (flag, value)]
+
+    def spawn_pipeline(stages):
+        # starts the stages, each one reading the output of the previous one,
+        # and returns the output pipe of the last stage
+        stdin = None
+        for stage in stages:
+            # (HGPLAIN only for hg itself, not e.g. an editor started later)
+            env = dict(os.environ, HGPLAIN='1') if stage[0] == 'hg' else None
+            try:
+                p = subprocess.Popen(stage, stdin=stdin, stdout=subprocess.PIPE, env=env)
+            except OSError as e:
+                raise SystemExit('%s: %s: %s' % (prog, stage[0], e.strerror))
+            if stdin is not None:
+                stdin.close()
+            stdin = p.stdout
+        return stdin
+
+    def exec_pipeline(stages):
+        # runs the pipeline without a shell, replacing this process with the
+        # last stage (so its exit status becomes ours)
+        if len(stages) > 1:
+            pipe = spawn_pipeline(stages[:-1])
+            os.dup2(pipe.fileno(), 0)
+            pipe.close()
+        # (like subprocess' restore_signals, undo Python's ignoring of these)
+        for sig in signal.SIGPIPE, signal.SIGXFSZ:
+            signal.signal(sig, signal.SIG_DFL)
+        try:
+            os.execvp(stages[-1][0], stages[-1])
+        except OSError as e:
+            raise SystemExit('%s: %s: %s' % (prog, stages[-1][0], e.strerror))
 
     if prog == 'hgg':
         if args.revisions:
             # grep only files changed since / between given revision(s)
-            cmd = "HGPLAIN=1 hg status --print0 --no-status -X 'set:symlink()' %s %s %s" % (
-                quote(args.include_globs, pattern='-I %s'),
-                quote(args.exclude_globs, pattern='-X %s'),
-                quote(args.revisions, '--rev %s'),
-            )
+            stages = [
+                ['hg', 'status', '--print0', '--no-status', '-X', 'set:symlink()']
+                + each('-I', args.include_globs)
+                + each('-X', args.exclude_globs)
+                + each('--rev', args.revisions),
+            ]
         else:
-            cmd = 'HGPLAIN=1 hg files --print0 %s %s' % (
-                quote(args.include_globs, pattern='-I %s'),
-                quote(args.exclude_globs, pattern='-X %s'),
-            )
             # filter out symlinks
             # (TODO: sed --null-data is not available on OS X)
             # Could use -X 'set:symlink()', but filesets are surprisingly slow in
             # Mercurial 4.2.2. Listing 50k files in a repo is 2.5s if using file
             # sets vs. 1.0s for the sed solution, quite a lot when the actual
             # grepping is only 0.6s.
-            cmd += ' --verbose | sed --null-data -n -e %s' % shlex.quote(r's/^.........[0-9] [^l] \(.*\)/\1/p')
+            # A template (-T '{flags} {path}\0') would avoid parsing the
+            # --verbose columns, but {path} is repo-relative in some Mercurial
+            # versions and cwd-relative in others, and splitting the flags off
+            # again takes a grep -z | cut pair, i.e. one process more than sed.
+            stages = [
+                ['hg', 'files', '--print0']
+                + each('-I', args.include_globs)
+                + each('-X', args.exclude_globs)
+                + ['--verbose'],
+                ['sed', '--null-data', '-n', '-e', r's/^.........[0-9] [^l] \(.*\)/\1/p'],
+            ]
     elif prog == 'ggit':
         if args.revisions:
             raise SystemExit('%s: --rev is not implemented for Git' % prog)
 
         # filter out symlinks, submodules
         # (TODO: sed --null-data is not available on OS X)
-        cmd = 'git ls-files --stage -z | sed --null-data -n -e %s' % shlex.quote(r's/^100... .*\t\(.*\)/\1/p')
+        stages = [
+            ['git', 'ls-files', '--stage', '-z'],
+            ['sed', '--null-data', '-n', '-e', r's/^100... .*\t\(.*\)/\1/p'],
+        ]
         if args.include_globs:
-            cmd += globs_to_grep_pipe(prog, args.include_globs)
+            stages.append(globs_to_grep_args(prog, args.include_globs))
         if args.exclude_globs:
-            cmd += globs_to_grep_pipe(prog, args.exclude_globs) + ' -v' # invert match
+            stages.append(globs_to_grep_args(prog, args.exclude_globs) + ['-v']) # invert match
     else:
         assert False, prog
 
@@ -382,43 +550,32 @@ only files changed between revisions R1 and R2.
         args.grep_args.extend(['-l', '--null'])
     else:
         args.grep_args.extend([args.grep_color_arg])
-    cmd += ' | xargs -0 %s %s --' % (grep, quote(args.grep_args))
+    stages.append(xargs + grep + args.grep_args + ['--'])
 
     if args.editor:
         if args.editor in editors_that_need_stdin and not args.show:
             # This editor needs stdin, so we need to use another FD than stdin with xargs.
             # Unless we're showing the command, because we can't show this workaround as a command.
 
-            def popen(shell_cmd, fds={}, **kwargs):
-                # Python 2.7:
-                if any(fds.values()):
-                    # if there are any fds we MUST pass, explicitly close the rest on exec
-                    kwargs['close_fds'] = False
-                    for fd, pass_fd in fds.items():
-                        fcntl.fcntl(fd, fcntl.F_SETFD, 0 if pass_fd else fcntl.FD_CLOEXEC)
-                else:
-                    # if there are no fds we MUST pass, just close them all on exec
-                    kwargs['close_fds'] = True
-
-                # Py3.2: pass_fds=[r] optional but better
-                return subprocess.Popen(shell_cmd, shell=True, **kwargs)
-
-            r, w = os.pipe()
-            p_grep = popen(cmd, fds={r: False, w: False}, stdout=w)
-            p_vim = popen(
-                'xargs --arg-file=/dev/fd/%d --no-run-if-empty -0 %s' % (r, args.editor),
-                fds={r: True, w: False})
-            os.close(r)
-            os.close(w)
-            p_grep.wait()
-            p_vim.wait()
-            sys.exit(0)
+            # replace ourselves with the editor xargs; the grep pipeline keeps
+            # feeding it through the pipe (which must stay open across exec)
+            # (hold on to the pipe object; if it's collected, the fd is closed)
+            pipe = spawn_pipeline(stages)
+            r = pipe.fileno()
+            os.set_inheritable(r, True)
+            exec_pipeline([
+                ['xargs', '--arg-file=/dev/fd/%d' % r, '--no-run-if-empty', '-0', args.editor],
+            ])
 
         else:
             # (TODO: xargs --no-run-if-empty is an unsupported option - but the standard behavior! - on OS X)
-            cmd += ' | xargs --no-run-if-empty -0 %s' % args.editor
+            stages.append(['xargs', '--no-run-if-empty', '-0', args.editor])
 
     if args.show:
+        # show the equivalent shell command
+        cmd = ' | '.join(quote(stage) for stage in stages)
+        if prog == 'hgg':
+            cmd = 'HGPLAIN=1 ' + cmd
         print(cmd)
     else:
-        sys.exit(os.system(cmd))
+        exec_pipeline(stages)